@@ -1,9 +1,14 @@
 import os
+import asyncio
 import platform
+import threading
+from collections import OrderedDict
+from typing import Tuple
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from rag_core import ensure_index, rebuild_index, retrieve, make_prompt
+from rag_core import (
+    ensure_index, rebuild_index, retrieve, aretrieve, make_prompt, get_openai_client, embed_batch, OPENAI_EMBED_MODEL
+)
 
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -29,21 +34,21 @@ with st.sidebar:
                 st.exception(e)
     k = st.slider("Top-K chunks", min_value=3, max_value=12, value=5, step=1)
     st.caption("Increase if answers miss context; decrease if answers seem noisy.")
+    use_rewrite = st.checkbox("Rewrite query before retrieval", value=False)
+    st.caption("Runs an LLM query rewrite concurrently with embedding and merges both result sets.")
 
-# Client helper (proxy-safe)
-def _make_openai_client():
-    import httpx
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("Missing OPENAI_API_KEY. Create `.env` from `.env`.")
-    proxy = os.getenv("OPENAI_PROXY") or os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
-    kwargs = {"api_key": api_key}
-    if proxy:
-        kwargs["http_client"] = httpx.Client(proxies=proxy, timeout=60.0)
-    return OpenAI(**kwargs)
-
-def call_llm(system_prompt: str, user_prompt: str) -> str:
-    client = _make_openai_client()
+@st.cache_resource(show_spinner=False)
+def _ensure_index_once():
+    return ensure_index()
+
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
+def embed_query(query: str, model: str = OPENAI_EMBED_MODEL):
+    # `model` is part of the cache key so switching embedding models never
+    # serves a vector from the old one.
+    return embed_batch([query])[0]
+
+def chat_completion(system_prompt: str, user_prompt: str) -> str:
+    client = get_openai_client()
     resp = client.chat.completions.create(
         model=MODEL_NAME,
         messages=[
@@ -54,6 +59,47 @@ def call_llm(system_prompt: str, user_prompt: str) -> str:
     )
     return resp.choices[0].message.content
 
+def yield_chat(system_prompt: str, user_prompt: str):
+    client = get_openai_client()
+    stream = client.chat.completions.create(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=0.2,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+@st.cache_resource(show_spinner=False)
+def _answer_cache() -> Tuple[OrderedDict, threading.Lock]:
+    # Shared by every session, so mutations go through the lock. Built inside
+    # cache_resource because module-level state is re-created on each rerun.
+    return OrderedDict(), threading.Lock()
+
+def stream_llm(system_prompt: str, user_prompt: str, max_entries: int = 256) -> str:
+    # Streams new answers token by token; identical (system, user) prompts
+    # replay the cached completion instead of calling the API again (LRU).
+    cache, lock = _answer_cache()
+    key = (system_prompt, user_prompt)
+    with lock:
+        answer = cache.get(key)
+        if answer is not None:
+            cache.move_to_end(key)
+    if answer is not None:
+        st.write(answer)
+        return answer
+    answer = st.write_stream(yield_chat(system_prompt, user_prompt))
+    with lock:
+        cache[key] = answer
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+    return answer
+
 tab_deep, tab_demo, tab_diag = st.tabs(["Deep Guide (Step-by-Step)", "Demo: Ask your docs", "Setup & Diagnostics"])
 
 # ------------------
@@ -70,7 +116,8 @@ relevant **chunks** from your knowledge base and **grounding** the LLM's answer
     st.markdown("""
 - **What:** Read files (`.pdf`, `.md`, `.txt`) from `./docs`.
 - **Why chunk:** Retrieval works on chunk-level granularity. Good defaults:
-  - `max_chars ≈ 700–1500`, `overlap ≈ 10–20%`.
+  - `max_tokens ≈ 256–512` (this app: 512 via `tiktoken`, the same units OpenAI bills in), `overlap ≈ 10–20%`.
+  - Character-based fallback: `max_chars ≈ 700–1500`.
   - Split on whitespace near the limit to avoid cutting sentences.
 - **Trade-offs:**
   - Too small → many irrelevant hits; too big → misses specific facts.
@@ -80,7 +127,10 @@ relevant **chunks** from your knowledge base and **grounding** the LLM's answer
     st.header("3) Embeddings & Vector Store")
     st.markdown("""
 - **Embedding model:** This project uses **OpenAI embeddings** (`text-embedding-3-small`) to avoid local installs.
+- **Dimensions:** v3 models are Matryoshka-trained, so the API can return truncated vectors. We request 512 dims (`OPENAI_EMBED_DIM`) instead of 1536:
+  3× less storage and 3× faster search for roughly 1% recall loss. Changing the size or model re-indexes from scratch.
 - **Vector DB:** **ChromaDB** (local, simple). Stores vectors + metadata (file path, chunk id).
+  Set `RAG_VECTOR_BACKEND=flat` for an exact brute-force store (one matrix product per query) — faster than HNSW up to ~100k chunks.
 - **Similarity:** cosine distance (Chroma default; we store normalized vectors on provider side).
     """)
 
@@ -88,7 +138,10 @@ relevant **chunks** from your knowledge base and **grounding** the LLM's answer
     st.markdown("""
 - Convert the **query** to an embedding.
 - Fetch **top-K** most similar chunks (tune `K` in the sidebar).
-- Optional: re-rank/filters by metadata (page, section) — omitted here for simplicity.
+- Optional: **query rewrite** (sidebar) — an LLM rewrites the question into a search query while the original is embedded; both are searched in one batched query and merged.
+- **Re-rank:** we over-fetch `3×K` candidates and re-score them as `0.7 × vector similarity + 0.3 × query-term coverage`,
+  then keep the top `K` — a cheap recall boost with no extra API calls or models.
+- Optional: filters by metadata (page, section) — omitted here for simplicity.
     """)
 
     st.header("5) Prompting & Generation")
@@ -110,8 +163,8 @@ relevant **chunks** from your knowledge base and **grounding** the LLM's answer
     st.header("7) Operations")
     st.markdown("""
 - **Cold start:** index empty → run **Rebuild Index**.
-- **Updates:** watch folders and re-chunk incrementally (future work).
-- **Caching:** memoize embeddings for repeated content.
+- **Updates:** **Rebuild Index** is incremental — chunk ids are content hashes, so only new or changed chunks are embedded and chunks from removed files are dropped.
+- **Caching:** embeddings are memoized on disk (`embcache.sqlite`, keyed by text hash + model), so unchanged chunks and repeat queries skip the API; the app also memoizes query embeddings and answers per process.
 - **Observability:** log retrieval hits & distances for debugging.
     """)
 
@@ -122,7 +175,7 @@ with tab_demo:
     st.header("Ask your documents")
     st.write("Put `.pdf`, `.md`, or `.txt` files in **`./docs`**, then rebuild the index from the sidebar.")
     try:
-        ensure_index()
+        _ensure_index_once()
     except Exception as e:
         st.error("Index not ready.")
         st.exception(e)
@@ -131,16 +184,17 @@ with tab_demo:
     if st.button("Go", type="primary") and query:
         try:
             with st.spinner("Retrieving..."):
-                hits = retrieve(query, k=k)
+                if use_rewrite:
+                    hits = asyncio.run(aretrieve(query, k=k, rewrite=True))
+                else:
+                    hits = retrieve(query, k=k, q_emb=embed_query(query, OPENAI_EMBED_MODEL))
             if not hits:
                 st.warning("No relevant chunks found. Try rebuilding the index or adding more docs.")
             else:
                 sys_prompt = "You are a helpful assistant. Prefer concise, citation-backed answers."
                 user_prompt = make_prompt(query, hits)
-                with st.spinner("Generating answer..."):
-                    answer = call_llm(sys_prompt, user_prompt)
                 st.subheader("Answer")
-                st.write(answer)
+                stream_llm(sys_prompt, user_prompt)
 
                 st.subheader("Top Matches")
                 for (_, meta, dist) in hits:
@@ -160,7 +214,7 @@ with tab_diag:
 
     if st.button("Test chat call"):
         try:
-            out = call_llm("You are a concise assistant.", "Reply with 'OK' if you can read this.")
+            out = chat_completion("You are a concise assistant.", "Reply with 'OK' if you can read this.")
             st.success(f"LLM reply: {out}")
         except Exception as e:
             st.error("Chat test failed.")
@@ -1,11 +1,27 @@
 import os
-import glob
-import uuid
-from typing import List, Tuple
-from pypdf import PdfReader
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import re
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
 from dotenv import load_dotenv
 import chromadb
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+
+from rag_io import read_txt_md, iter_pages, read_pdf, pdf_page_count, extract_one  # noqa: F401 (re-exported)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 load_dotenv()
 
@@ -13,124 +29,738 @@ DATA_DIR = os.getenv("RAG_DATA_DIR", "docs")
 PERSIST_DIR = os.getenv("RAG_PERSIST_DIR", "chroma")
 COLLECTION_NAME = os.getenv("RAG_COLLECTION_NAME", "docs")
 OPENAI_EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+# v3 embedding models can be truncated server-side; 0 keeps the model's full size.
+OPENAI_EMBED_DIM = int(os.getenv("OPENAI_EMBED_DIM", "512")) or None
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "16"))
+EMBED_CACHE_PATH = os.path.join(PERSIST_DIR, "embcache.sqlite")
+VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "chroma").lower()
+FLAT_DTYPE = os.getenv("RAG_FLAT_DTYPE", "float32").lower()
+PDF_PAGES_PER_TASK = 8
+CHUNK_MODE = os.getenv("RAG_CHUNKING", "tokens").lower()
 
 # ------------------
-# I/O
+# I/O (file readers live in rag_io so pool workers import nothing else)
 # ------------------
-def read_txt_md(path: str) -> str:
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.read()
-
-def read_pdf(path: str) -> str:
-    reader = PdfReader(path)
-    texts = []
-    for i, page in enumerate(reader.pages):
+def _plan_extraction(paths: Iterable[str]) -> Iterator[Tuple[str, int, int]]:
+    # Large PDFs are split into page ranges so a single big file still
+    # spreads across all workers instead of pinning one core.
+    for path in paths:
+        if not path.lower().endswith(".pdf"):
+            yield (path, 0, 0)
+            continue
         try:
-            texts.append(page.extract_text() or "")
+            n = pdf_page_count(path)
         except Exception:
-            texts.append("")
-    return "\n".join(texts)
+            continue
+        for start in range(0, n, PDF_PAGES_PER_TASK):
+            yield (path, start, min(start + PDF_PAGES_PER_TASK, n))
+
+def _iter_extracted(tasks: Iterable[Tuple[str, int, int]]) -> Iterator[dict]:
+    """Yield extraction results in task order, keeping only a few ranges in flight.
+
+    Text files are I/O-bound and read inline; only PDF page ranges that
+    have another range after them go to the process pool, which is
+    started on first use.
+    """
+    tasks = iter(tasks)
+    workers = os.cpu_count() or 1
+    pool = None
+    pending = deque()  # (future, task); future is None for inline reads
+    try:
+        t = next(tasks, None)
+        while t is not None:
+            nxt = next(tasks, None)
+            is_pdf = t[0].lower().endswith(".pdf")
+            if is_pdf and (pool is not None or (nxt is not None and nxt[0].lower().endswith(".pdf"))):
+                if pool is None:
+                    # Never fork: this runs on the rebuild producer thread of a
+                    # multi-threaded (Streamlit) process.
+                    methods = multiprocessing.get_all_start_methods()
+                    ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                    pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+                pending.append((pool.submit(extract_one, t), t))
+            else:
+                pending.append((None, t))
+            while pending and (pending[0][0] is None or len(pending) >= 2 * workers):
+                fut, task = pending.popleft()
+                yield fut.result() if fut else extract_one(task)
+            t = nxt
+        while pending:
+            fut, task = pending.popleft()
+            yield fut.result() if fut else extract_one(task)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+DOC_EXTENSIONS = {".txt", ".md", ".pdf"}
+
+def _iter_paths() -> Iterator[str]:
+    """Lazily walk DATA_DIR for supported files, skipping hidden entries like glob did.
+
+    Symlinked directories are followed (as glob's `**` did); each directory
+    is visited once, so link cycles terminate.
+    """
+    seen = set()
+    for root, dirs, files in os.walk(DATA_DIR, followlinks=True):
+        st = os.stat(root)
+        if (st.st_dev, st.st_ino) in seen:
+            dirs[:] = []
+            continue
+        seen.add((st.st_dev, st.st_ino))
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            if os.path.splitext(name)[1].lower() in DOC_EXTENSIONS:
+                yield os.path.join(root, name)
+
+def _iter_pieces() -> Iterator[Tuple[str, Iterator[str]]]:
+    # Tasks for one file are consecutive, so groupby yields each file's
+    # page ranges as a lazy stream.
+    parts = _iter_extracted(_plan_extraction(_iter_paths()))
+    for path, group in groupby(parts, key=lambda p: p["path"]):
+        yield path, (p["text"] for p in group)
 
 def load_documents() -> List[dict]:
     docs = []
-    for path in glob.glob(os.path.join(DATA_DIR, "**/*"), recursive=True):
-        if os.path.isdir(path):
-            continue
-        ext = os.path.splitext(path)[1].lower()
-        if ext in [".txt", ".md"]:
-            content = read_txt_md(path)
-        elif ext in [".pdf"]:
-            content = read_pdf(path)
-        else:
-            continue
+    for path, pieces in _iter_pieces():
+        content = "\n".join(pieces)
         if content.strip():
             docs.append({"path": path, "text": content})
     return docs
 
+def iter_document_chunks() -> Iterator[Tuple[str, int, str]]:
+    """Stream (path, chunk_id, text) for every chunk in DATA_DIR, page range by page range."""
+    chunker = iter_token_chunks if _use_tokens() else iter_chunks
+    for path, pieces in _iter_pieces():
+        for i, ch in enumerate(chunker(pieces)):
+            yield path, i, ch
+
 # ------------------
-# Chunking (character-based to avoid tiktoken)
+# Chunking (token-based via tiktoken; character-based fallback)
 # ------------------
 def chunk_text(text: str, max_chars: int = 1500, overlap: int = 200) -> List[str]:
-    chunks = []
-    n = len(text)
+    return list(iter_chunks([text], max_chars, overlap))
+
+def iter_chunks(pieces: Iterable[str], max_chars: int = 1500, overlap: int = 200) -> Iterator[str]:
+    """Chunk a stream of text pieces (e.g. pages) as if they were joined with newlines.
+
+    Only the unchunked tail (< max_chars plus the overlap carry-over) is kept
+    between pieces, so chunks still span page boundaries. Within a piece a
+    start offset walks the buffer; it is only compacted when the next piece
+    arrives, so a single large piece chunks in linear time.
+    """
+    buf = ""
     start = 0
-    while start < n:
-        end = min(start + max_chars, n)
-        cut = text.rfind(" ", start, end)
-        if cut == -1 or cut < start + int(max_chars * 0.6):
-            cut = end
-        chunk = text[start:cut].strip()
+    first = True
+    done = False
+    min_cut = int(max_chars * 0.6)
+    pieces = iter(pieces)
+    while not done:
+        piece = next(pieces, None)
+        if piece is None:
+            done = True
+        else:
+            buf = piece if first else buf[start:] + "\n" + piece
+            start = 0
+            first = False
+        n = len(buf)
+        # Mid-stream, only cut while a full window is buffered; at the end,
+        # drain whatever is left.
+        while n - start > max_chars or (done and start < n):
+            end = min(start + max_chars, n)
+            cut = buf.rfind(" ", start, end)
+            if cut == -1 or cut < start + min_cut:
+                cut = end
+            chunk = buf[start:cut].strip()
+            if chunk:
+                yield chunk
+            if cut == n:
+                break
+            start = max(start, cut - overlap)
+
+_encoding = None
+_encoding_failed = False
+
+def _get_encoding():
+    # tiktoken downloads its BPE file on first use; if that fails (offline
+    # host) fall back to character chunking instead of failing ingestion.
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        try:
+            try:
+                _encoding = tiktoken.encoding_for_model(OPENAI_EMBED_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding_failed = True
+    return _encoding
+
+def _use_tokens() -> bool:
+    return CHUNK_MODE == "tokens" and _get_encoding() is not None
+
+def _char_boundary(enc, ids: List[int], i: int, lo: int) -> int:
+    """Back `i` off (at most 3 tokens, staying above `lo`) to a token that starts a UTF-8 character.
+
+    Byte-level tokens can split a multi-byte character; decoding such a
+    slice would put U+FFFD into the chunk text.
+    """
+    for j in range(i, max(lo, i - 4), -1):
+        if j >= len(ids) or enc.decode_single_token_bytes(ids[j])[0] & 0xC0 != 0x80:
+            return j
+    return i
+
+def _word_boundary(enc, ids: List[int], i: int, lo: int) -> int:
+    """Cut before the last whitespace-led token in the window's final 40% (like the char chunker), else at a character boundary."""
+    for j in range(i, lo + int((i - lo) * 0.6), -1):
+        if enc.decode_single_token_bytes(ids[j])[:1].isspace():
+            return j
+    return _char_boundary(enc, ids, i, lo)
+
+def iter_token_chunks(pieces: Iterable[str], max_tokens: int = 512, overlap_tokens: int = 64) -> Iterator[str]:
+    """Token-sized chunks over a stream of text pieces.
+
+    Each piece is encoded once; chunks are decoded from windows of the
+    token-id buffer walked by a start index (compacted only when the next
+    piece arrives). Windows end on whitespace near the limit when possible;
+    every edge is moved to a character boundary.
+    """
+    enc = _get_encoding()
+    buf: List[int] = []
+    start = 0
+    emitted = 0  # end of the last emitted window
+    first = True
+    for piece in pieces:
+        if start:
+            buf = buf[start:]
+            emitted -= start
+            start = 0
+        buf.extend(enc.encode(piece if first else "\n" + piece, disallowed_special=()))
+        first = False
+        while len(buf) - start > max_tokens:
+            end = _word_boundary(enc, buf, start + max_tokens, start)
+            chunk = enc.decode(buf[start:end]).strip()
+            if chunk:
+                yield chunk
+            emitted = end
+            start = _char_boundary(enc, buf, max(end - overlap_tokens, start + 1), start)
+    # Skip a tail that is nothing but the previous chunk's overlap.
+    if len(buf) > emitted:
+        chunk = enc.decode(buf[start:]).strip()
         if chunk:
-            chunks.append(chunk)
-        if cut == n:
-            break
-        start = max(0, cut - overlap)
-    return chunks
+            yield chunk
+
+def chunk_tokens(text: str, max_tokens: int = 512, overlap_tokens: int = 64) -> List[str]:
+    return list(iter_token_chunks([text], max_tokens, overlap_tokens))
 
 # ------------------
 # OpenAI client (proxy-safe)
 # ------------------
-def _make_openai_client() -> OpenAI:
-    import httpx
+def _openai_settings() -> Tuple[str, str]:
+    """(api_key, proxy) shared by the sync and async client constructors."""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise RuntimeError("Missing OPENAI_API_KEY")
     proxy = os.getenv("OPENAI_PROXY") or os.getenv("HTTPS_PROXY") or os.getenv("HTTP_PROXY")
+    return api_key, proxy
+
+def _make_openai_client() -> OpenAI:
+    import httpx
+    api_key, proxy = _openai_settings()
     kwargs = {"api_key": api_key}
     if proxy:
         kwargs["http_client"] = httpx.Client(proxies=proxy, timeout=60.0)
     return OpenAI(**kwargs)
 
-def embed_batch(texts: List[str]) -> List[List[float]]:
-    client = _make_openai_client()
-    resp = client.embeddings.create(model=OPENAI_EMBED_MODEL, input=texts)
-    return [d.embedding for d in resp.data]
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+def get_openai_client() -> OpenAI:
+    """Process-wide OpenAI client, so requests reuse one keep-alive connection pool."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                _openai_client = _make_openai_client()
+    return _openai_client
+
+def _make_async_openai_client() -> AsyncOpenAI:
+    # httpx.AsyncClient pools are bound to the event loop that created them,
+    # so this is built once per asyncio.run() rather than cached globally.
+    import httpx
+    api_key, proxy = _openai_settings()
+    http_kwargs = {"timeout": 60.0, "limits": httpx.Limits(max_connections=64)}
+    if proxy:
+        http_kwargs["proxies"] = proxy
+    return AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(**http_kwargs))
+
+# ------------------
+# Embedding cache (sqlite, keyed by sha256(text) + model[:dim])
+# ------------------
+_CACHE_MODEL_KEY = f"{OPENAI_EMBED_MODEL}:{OPENAI_EMBED_DIM}" if OPENAI_EMBED_DIM else OPENAI_EMBED_MODEL
+_cache_conn = None
+_cache_lock = threading.Lock()
+
+def _get_cache() -> sqlite3.Connection:
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(PERSIST_DIR, exist_ok=True)
+        conn = sqlite3.connect(EMBED_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb(hash BLOB, model TEXT, vec BLOB, PRIMARY KEY(hash, model))"
+        )
+        conn.commit()
+        _cache_conn = conn
+    return _cache_conn
+
+def _cache_lookup(texts: List[str]) -> Tuple[List[bytes], Dict[bytes, np.ndarray], Dict[bytes, str]]:
+    """Return (hashes, hits, misses); misses maps hash -> text, deduplicated."""
+    hashes = [hashlib.sha256(t.encode("utf-8")).digest() for t in texts]
+    hits: Dict[bytes, np.ndarray] = {}
+    unique = list(dict.fromkeys(hashes))
+    with _cache_lock:
+        conn = _get_cache()
+        for i in range(0, len(unique), 500):
+            part = unique[i:i+500]
+            rows = conn.execute(
+                f"SELECT hash, vec FROM emb WHERE model=? AND hash IN ({','.join('?' * len(part))})",
+                [_CACHE_MODEL_KEY, *part],
+            ).fetchall()
+            for h, blob in rows:
+                hits[h] = np.frombuffer(blob, dtype=np.float32)
+    misses = {h: t for h, t in zip(hashes, texts) if h not in hits}
+    return hashes, hits, misses
+
+def _cache_store(fresh: Dict[bytes, np.ndarray]) -> None:
+    if not fresh:
+        return
+    with _cache_lock:
+        conn = _get_cache()
+        conn.executemany(
+            "INSERT OR REPLACE INTO emb(hash, model, vec) VALUES (?, ?, ?)",
+            [(h, _CACHE_MODEL_KEY, v.tobytes()) for h, v in fresh.items()],
+        )
+        conn.commit()
+
+def _embed_kwargs() -> dict:
+    kwargs = {"model": OPENAI_EMBED_MODEL}
+    if OPENAI_EMBED_DIM:
+        kwargs["dimensions"] = OPENAI_EMBED_DIM
+    return kwargs
+
+def _as_float32(resp) -> np.ndarray:
+    return np.asarray([d.embedding for d in resp.data], dtype=np.float32)
+
+def embed_batch(texts: List[str]) -> np.ndarray:
+    """Embed texts as a (len(texts), dim) float32 array."""
+    hashes, hits, misses = _cache_lookup(texts)
+    if misses:
+        client = get_openai_client()
+        resp = client.embeddings.create(input=list(misses.values()), **_embed_kwargs())
+        fresh = dict(zip(misses, _as_float32(resp)))
+        _cache_store(fresh)
+        hits.update(fresh)
+    return np.stack([hits[h] for h in hashes])
+
+async def aembed_batch(texts: List[str], client: AsyncOpenAI) -> np.ndarray:
+    hashes, hits, misses = _cache_lookup(texts)
+    if misses:
+        resp = await client.embeddings.create(input=list(misses.values()), **_embed_kwargs())
+        fresh = dict(zip(misses, _as_float32(resp)))
+        _cache_store(fresh)
+        hits.update(fresh)
+    return np.stack([hits[h] for h in hashes])
 
 # ------------------
 # Vector DB
 # ------------------
+class FlatStore:
+    """Brute-force cosine store for small corpora (RAG_VECTOR_BACKEND=flat).
+
+    Implements the subset of the Chroma collection API used here (count,
+    get, upsert, delete, query). Vectors are L2-normalized on insert and
+    kept in a memmap, so a query is one matrix product. `dtype` selects the
+    stored precision: float32, float16 (2x smaller) or int8 (4x smaller,
+    one float32 scale per vector; queries stay float32). Layout in `path`:
+    `vecs.<f32|f16|i8>`, `scales.f32` (int8 only), `metas.jsonl` (one
+    {"id","document","metadata"} row per vector) and `flat.json`.
+    """
+
+    _SUFFIX = {"float32": "f32", "float16": "f16", "int8": "i8"}
+    _BLOCK = 16384  # rows widened to float32 at a time when scoring float16/int8
+
+    def __init__(self, path: str, dtype: str = "float32", stamp: dict = None):
+        if dtype not in self._SUFFIX:
+            raise ValueError(f"Unsupported flat store dtype: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.stamp = dict(stamp or {})
+        self._np_dtype = np.dtype(dtype)
+        self._vec_path = os.path.join(path, f"vecs.{self._SUFFIX[dtype]}")
+        self._scale_path = os.path.join(path, "scales.f32")
+        self._meta_path = os.path.join(path, "metas.jsonl")
+        self._info_path = os.path.join(path, "flat.json")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    @property
+    def _quantized(self) -> bool:
+        return self.dtype == "int8"
+
+    def _reset(self) -> None:
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        self.dim = 0
+        self.rows = []
+
+    def _load(self) -> None:
+        self.dim = 0
+        self.rows: List[dict] = []
+        if os.path.exists(self._info_path) and os.path.exists(self._meta_path):
+            with open(self._info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            if info.get("dtype", "float32") != self.dtype or any(info.get(k) != v for k, v in self.stamp.items()):
+                # Stored at another precision (int8 can't be widened back) or
+                # with another embedding config: start empty and let the
+                # rebuild refill it from the embedding cache.
+                self._reset()
+            else:
+                self.dim = info["dim"]
+                try:
+                    self.rows = self._read_rows()
+                except ValueError:
+                    # Corrupt metadata: start empty and let the rebuild refill it.
+                    self.rows = []
+                files = [(self._vec_path, self.dim * self._np_dtype.itemsize)]
+                if self._quantized:
+                    files.append((self._scale_path, 4))
+                for path, row_bytes in files:
+                    expected = len(self.rows) * row_bytes
+                    size = os.path.getsize(path) if os.path.exists(path) else 0
+                    if size < expected:
+                        # Vectors missing for some rows: treat as an empty index.
+                        self._reset()
+                        break
+                    if size > expected:
+                        # Interrupted append (vectors written, metadata not): drop the tail.
+                        with open(path, "r+b") as f:
+                            f.truncate(expected)
+        if not self.rows and os.listdir(self.path):
+            # Crash during the first batch (or a reset above): drop leftover
+            # vectors so the next append doesn't land behind stale rows.
+            self._reset()
+        self.index = {r["id"]: n for n, r in enumerate(self.rows)}
+        self._map()
+
+    def _read_rows(self) -> List[dict]:
+        """Rows of metas.jsonl; a torn final line (crash mid-append) is truncated away."""
+        with open(self._meta_path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            with open(self._meta_path, "r+b") as f:
+                f.truncate(end)
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+    def _map(self) -> None:
+        if self.rows:
+            shape = (len(self.rows), self.dim)
+            self.vecs = np.memmap(self._vec_path, dtype=self._np_dtype, mode="r", shape=shape)
+            self.scales = (
+                np.memmap(self._scale_path, dtype=np.float32, mode="r", shape=(len(self.rows),))
+                if self._quantized else None
+            )
+        else:
+            self.vecs = np.empty((0, self.dim), dtype=self._np_dtype)
+            self.scales = np.empty((0,), dtype=np.float32) if self._quantized else None
+
+    def _encode(self, vecs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        if not self._quantized:
+            return vecs.astype(self._np_dtype), None
+        scales = np.maximum(np.abs(vecs).max(axis=1), 1e-12) / 127.0
+        q = np.round(vecs / scales[:, None]).astype(np.int8)
+        return q, scales.astype(np.float32)
+
+    def _rewrite(self, vecs: np.ndarray, scales: np.ndarray, rows: List[dict]) -> None:
+        self.vecs = self.scales = None  # release the memmaps before replacing files
+        np.ascontiguousarray(vecs, dtype=self._np_dtype).tofile(self._vec_path + ".tmp")
+        if self._quantized:
+            np.ascontiguousarray(scales, dtype=np.float32).tofile(self._scale_path + ".tmp")
+        with open(self._meta_path + ".tmp", "w", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r) + "\n")
+        os.replace(self._vec_path + ".tmp", self._vec_path)
+        if self._quantized:
+            os.replace(self._scale_path + ".tmp", self._scale_path)
+        os.replace(self._meta_path + ".tmp", self._meta_path)
+        self.rows = rows
+        self.index = {r["id"]: n for n, r in enumerate(rows)}
+        self._map()
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def get(self, ids: List[str] = None, include=None) -> dict:
+        with self._lock:
+            if ids is None:
+                return {"ids": [r["id"] for r in self.rows]}
+            return {"ids": [i for i in ids if i in self.index]}
+
+    def upsert(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict]) -> None:
+        vecs, scales = self._encode(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            if not self.dim:
+                self.dim = vecs.shape[1]
+                with open(self._info_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype, **self.stamp}, f)
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f"Embedding dim {vecs.shape[1]} does not match index dim {self.dim}")
+            new_rows = [{"id": i, "document": d, "metadata": m} for i, d, m in zip(ids, documents, metadatas)]
+            if any(i in self.index for i in ids):
+                all_vecs = np.array(self.vecs)
+                all_scales = np.array(self.scales) if self._quantized else None
+                rows = list(self.rows)
+                extra = []
+                for j, r in enumerate(new_rows):
+                    n = self.index.get(r["id"])
+                    if n is None:
+                        extra.append(j)
+                        continue
+                    all_vecs[n] = vecs[j]
+                    if self._quantized:
+                        all_scales[n] = scales[j]
+                    rows[n] = r
+                if extra:
+                    all_vecs = np.vstack([all_vecs, vecs[extra]])
+                    if self._quantized:
+                        all_scales = np.concatenate([all_scales, scales[extra]])
+                self._rewrite(all_vecs, all_scales, rows + [new_rows[j] for j in extra])
+                return
+            # Fast path: pure append (the common case for incremental rebuilds).
+            with open(self._vec_path, "ab") as f:
+                vecs.tofile(f)
+            if self._quantized:
+                with open(self._scale_path, "ab") as f:
+                    scales.tofile(f)
+            with open(self._meta_path, "a", encoding="utf-8") as f:
+                for r in new_rows:
+                    f.write(json.dumps(r) + "\n")
+            for r in new_rows:
+                self.index[r["id"]] = len(self.rows)
+                self.rows.append(r)
+            self._map()
+
+    def delete(self, ids: List[str]) -> None:
+        drop = set(ids)
+        with self._lock:
+            keep = [n for n, r in enumerate(self.rows) if r["id"] not in drop]
+            if len(keep) == len(self.rows):
+                return
+            scales = np.asarray(self.scales)[keep] if self._quantized else None
+            self._rewrite(np.asarray(self.vecs)[keep], scales, [self.rows[n] for n in keep])
+
+    def _scores(self, q: np.ndarray) -> np.ndarray:
+        """(N, Q) cosine scores of every stored vector against float32 queries."""
+        if self.dtype == "float32":
+            return self.vecs @ q.T
+        # float16/int8 rows are widened block by block so a query never holds
+        # a full float32 copy; the int8 per-row scale is applied to the dot
+        # product rather than to each element.
+        out = np.empty((len(self.rows), len(q)), dtype=np.float32)
+        for i in range(0, len(self.rows), self._BLOCK):
+            out[i:i+self._BLOCK] = self.vecs[i:i+self._BLOCK].astype(np.float32) @ q.T
+            if self._quantized:
+                out[i:i+self._BLOCK] *= self.scales[i:i+self._BLOCK, None]
+        return out
+
+    def query(self, query_embeddings, n_results: int = 5, include=None) -> dict:
+        q = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        out = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        with self._lock:
+            n = len(self.rows)
+            k = min(n_results, n)
+            scores = self._scores(q) if n else np.empty((0, len(q)), dtype=np.float32)
+            for col in scores.T:
+                if k < n:
+                    top = np.argpartition(-col, k - 1)[:k]
+                    top = top[np.argsort(-col[top])]
+                else:
+                    top = np.argsort(-col)[:k]
+                rows = [self.rows[t] for t in top]
+                out["ids"].append([r["id"] for r in rows])
+                out["documents"].append([r["document"] for r in rows])
+                out["metadatas"].append([r["metadata"] for r in rows])
+                out["distances"].append([float(1.0 - col[t]) for t in top])
+        return out
+
 client = chromadb.PersistentClient(path=PERSIST_DIR)
-try:
-    collection = client.get_collection(COLLECTION_NAME)
-except Exception:
-    collection = client.create_collection(COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
 
-def rebuild_index(progress_cb=None) -> Tuple[chromadb.api.models.Collection.Collection, int, int]:
-    global collection
+def _embed_stamp() -> dict:
+    """Embedding config an index was built with; stored on the collection."""
+    return {"embed_model": OPENAI_EMBED_MODEL, "embed_dim": str(OPENAI_EMBED_DIM or "full")}
+
+def _stamp_changed(coll) -> bool:
+    """True if `coll` was built with a different embedding config (or predates stamping)."""
+    meta = coll.metadata or {}
+    return any(meta.get(k) != v for k, v in _embed_stamp().items())
+
+def _open_collection():
+    if VECTOR_BACKEND == "flat":
+        # FlatStore resets itself on a stamp mismatch when loaded.
+        return FlatStore(os.path.join(PERSIST_DIR, "flat"), dtype=FLAT_DTYPE, stamp=_embed_stamp())
+    # Read the stored stamp before writing one: get_or_create_collection
+    # would overwrite an existing collection's metadata with the current
+    # stamp and hide the mismatch.
     try:
-        client.delete_collection(COLLECTION_NAME)
+        coll = client.get_collection(COLLECTION_NAME)
     except Exception:
-        pass
-    collection = client.create_collection(COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+        coll = None
+    if coll is not None:
+        if not _stamp_changed(coll):
+            return coll
+        # Chunk ids don't encode the embedding config, so vectors built with
+        # the old one would otherwise be kept as "unchanged".
+        client.delete_collection(COLLECTION_NAME)
+    return client.create_collection(
+        COLLECTION_NAME, metadata={"hnsw:space": "cosine", **_embed_stamp()}
+    )
 
-    docs = load_documents()
-    if not docs:
-        if progress_cb: progress_cb("No documents found in ./docs. Add PDFs, .txt, or .md and rebuild.")
-        return collection, 0, 0
+collection = _open_collection()
 
-    ids, texts, metadatas = [], [], []
-    total_chunks = 0
-    for d in docs:
-        chunks = chunk_text(d["text"])
-        for i, ch in enumerate(chunks):
-            ids.append(str(uuid.uuid4()))
-            texts.append(ch)
-            metadatas.append({"source": d["path"], "chunk_id": i})
-        total_chunks += len(chunks)
+def chunk_id(path: str, i: int, text: str) -> str:
+    """Deterministic chunk id: same file, position and text -> same id across rebuilds.
+
+    The embedding model isn't part of the id: `_open_collection` drops a
+    collection stamped with another model (the embedding cache is keyed by
+    model:dim, so queries always use the current one) and the rebuild then
+    re-embeds every chunk.
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(f"{path}:{i}:{digest}".encode("utf-8"), digest_size=16).hexdigest()
+
+async def _rebuild_async(progress_cb=None) -> Tuple[chromadb.api.models.Collection.Collection, int, int]:
+    global collection
+    collection = _open_collection()
+    existing = set(collection.get(include=[])["ids"])
 
+    # Three-stage pipeline so chunking CPU and embedding I/O overlap:
+    #   producer thread (extract + chunk) -> batch_q -> EMBED_CONCURRENCY
+    #   embed workers -> write_q -> single Chroma writer.
+    # Both queues are bounded, so the producer stalls instead of racing ahead
+    # and only O(BATCH * (queue sizes + workers)) chunk texts are ever resident.
     BATCH = 64
-    for i in range(0, len(texts), BATCH):
-        batch_texts = texts[i:i+BATCH]
-        batch_ids = ids[i:i+BATCH]
-        batch_meta = metadatas[i:i+BATCH]
-        embs = embed_batch(batch_texts)
-        collection.add(documents=batch_texts, ids=batch_ids, embeddings=embs, metadatas=batch_meta)
-        if progress_cb:
-            progress_cb(f"Indexed {min(i+BATCH, len(texts))}/{len(texts)} chunks...")
+    loop = asyncio.get_running_loop()
+    batch_q: asyncio.Queue = asyncio.Queue(maxsize=4)
+    write_q: asyncio.Queue = asyncio.Queue(maxsize=4)
+    stop = threading.Event()
+    stats = {"total": 0, "new": 0, "files": 0}
 
+    def put(item):
+        asyncio.run_coroutine_threadsafe(batch_q.put(item), loop).result()
+
+    def produce():
+        # Ids are derived from content, so chunks already in the collection
+        # are skipped entirely (no embedding call, no HNSW insert). Pending
+        # chunks are kept as parallel columns; metadata dicts are only built
+        # per batch by the writer.
+        # Seen ids are removed from `existing` as we go, so whatever is left at
+        # the end is stale and no per-run set of all ids is needed.
+        ids, texts, paths, nums = [], [], [], []
+        last_path = None
+        try:
+            for path, i, ch in iter_document_chunks():
+                if stop.is_set():
+                    return
+                cid = chunk_id(path, i, ch)
+                if path != last_path:
+                    stats["files"] += 1
+                    last_path = path
+                stats["total"] += 1
+                if cid in existing:
+                    existing.discard(cid)
+                    continue
+                ids.append(cid)
+                texts.append(ch)
+                paths.append(path)
+                nums.append(i)
+                if len(ids) == BATCH:
+                    put((texts, ids, paths, nums))
+                    ids, texts, paths, nums = [], [], [], []
+            if ids:
+                put((texts, ids, paths, nums))
+        finally:
+            put(None)
+
+    async def embed_worker():
+        while True:
+            batch = await batch_q.get()
+            if batch is None:
+                await batch_q.put(None)  # let the other workers see it too
+                return
+            embs = await aembed_batch(batch[0], aclient)
+            await write_q.put((batch, embs))
+
+    async def writer():
+        while True:
+            item = await write_q.get()
+            if item is None:
+                break
+            (batch_texts, batch_ids, batch_paths, batch_nums), embs = item
+            batch_meta = [{"source": p, "chunk_id": n} for p, n in zip(batch_paths, batch_nums)]
+            await asyncio.to_thread(
+                collection.upsert, documents=batch_texts, ids=batch_ids, embeddings=embs, metadatas=batch_meta
+            )
+            stats["new"] += len(batch_texts)
+            if progress_cb:
+                progress_cb(f"Indexed {stats['new']} new chunks...")
+
+    aclient = _make_async_openai_client()
+    producer = loop.run_in_executor(None, produce)
+    workers = [asyncio.create_task(embed_worker()) for _ in range(EMBED_CONCURRENCY)]
+    writer_task = asyncio.create_task(writer())
+
+    async def embed_all():
+        await asyncio.gather(*workers)
+        await write_q.put(None)
+
+    try:
+        await asyncio.gather(embed_all(), writer_task)
+    except BaseException:
+        stop.set()
+        for t in workers + [writer_task]:
+            t.cancel()
+        # Drain so a producer blocked on a full queue can observe `stop`.
+        while not producer.done():
+            while not batch_q.empty():
+                batch_q.get_nowait()
+            await asyncio.sleep(0.05)
+        raise
+    finally:
+        await aclient.close()
+    await producer  # re-raise extraction/chunking errors before pruning
+
+    # Only prune after a complete pass; `existing` still holds live ids otherwise.
+    stale = list(existing)
+    if stale:
+        collection.delete(ids=stale)
+    total_chunks = stats["total"]
+    if not total_chunks:
+        if progress_cb: progress_cb("No documents found in ./docs. Add PDFs, .txt, or .md and rebuild.")
+        return collection, 0, 0
     if progress_cb:
-        progress_cb(f"Ingested {total_chunks} chunks from {len(docs)} files.")
-    return collection, total_chunks, len(docs)
+        progress_cb(
+            f"Ingested {total_chunks} chunks from {stats['files']} files "
+            f"({stats['new']} new, {total_chunks - stats['new']} unchanged, {len(stale)} removed)."
+        )
+    return collection, total_chunks, stats["files"]
+
+def rebuild_index(progress_cb=None) -> Tuple[chromadb.api.models.Collection.Collection, int, int]:
+    return asyncio.run(_rebuild_async(progress_cb))
 
 def ensure_index():
     global collection
@@ -142,17 +772,108 @@ def ensure_index():
         rebuild_index()
     return collection
 
-def retrieve(query: str, k: int = 5):
-    q_emb = embed_batch([query])[0]
+RERANK_OVERFETCH = 3
+RERANK_VECTOR_WEIGHT = 0.7
+
+@lru_cache(maxsize=1024)
+def _query_terms(query: str) -> Tuple[str, ...]:
+    return tuple(dict.fromkeys(re.findall(r"\w+", query.lower())))
+
+def rerank(query: str, hits: List[Tuple[str, dict, float]], k: int) -> List[Tuple[str, dict, float]]:
+    """Fuse vector similarity with query-term coverage and keep the top k.
+
+    score = 0.7 * (1 - distance) + 0.3 * (fraction of query terms present in
+    the chunk). No extra API calls; the original distance is returned
+    unchanged so callers can still show it as relevance.
+    """
+    terms = _query_terms(query)
+    if not hits or not terms:
+        return hits[:k]
+    lowered = [txt.lower() for txt, _, _ in hits]
+    present = np.array([[t in doc for t in terms] for doc in lowered], dtype=bool)
+    lex = present.mean(axis=1)
+    sim = 1.0 - np.array([dist for _, _, dist in hits], dtype=np.float32)
+    score = RERANK_VECTOR_WEIGHT * sim + (1.0 - RERANK_VECTOR_WEIGHT) * lex
+    order = np.argsort(-score, kind="stable")[:k]
+    return [hits[i] for i in order]
+
+def retrieve_many(queries: List[str], k: int = 5, q_embs: np.ndarray = None, rerank_hits: bool = True) -> List[List[Tuple[str, dict, float]]]:
+    """Retrieve top-k hits for several queries with one embedding call and one Chroma query.
+
+    Pass q_embs to reuse query embeddings computed (or cached) by the caller.
+    With rerank_hits, RERANK_OVERFETCH * k candidates are fetched per query and
+    re-ranked by `rerank`.
+    """
+    if not queries:
+        return []
+    if q_embs is None:
+        q_embs = embed_batch(queries)
     results = collection.query(
-        query_embeddings=[q_emb],
-        n_results=k,
+        query_embeddings=q_embs,
+        n_results=k * RERANK_OVERFETCH if rerank_hits else k,
         include=["documents", "metadatas", "distances"]
     )
-    docs = results.get("documents", [[]])[0]
-    metas = results.get("metadatas", [[]])[0]
-    dists = results.get("distances", [[]])[0]
-    return list(zip(docs, metas, dists))
+    docs = results.get("documents") or [[] for _ in queries]
+    metas = results.get("metadatas") or [[] for _ in queries]
+    dists = results.get("distances") or [[] for _ in queries]
+    hit_lists = [list(zip(d, m, s)) for d, m, s in zip(docs, metas, dists)]
+    if rerank_hits:
+        hit_lists = [rerank(q, hits, k) for q, hits in zip(queries, hit_lists)]
+    return hit_lists
+
+def retrieve(query: str, k: int = 5, q_emb: np.ndarray = None):
+    q_embs = None if q_emb is None else np.asarray(q_emb, dtype=np.float32).reshape(1, -1)
+    return retrieve_many([query], k=k, q_embs=q_embs)[0]
+
+async def arewrite_query(query: str, client: AsyncOpenAI) -> str:
+    resp = await client.chat.completions.create(
+        model=OPENAI_CHAT_MODEL,
+        messages=[
+            {"role": "system", "content": "Rewrite the user's question as a short, keyword-rich search query. Reply with the query only."},
+            {"role": "user", "content": query}
+        ],
+        temperature=0
+    )
+    return (resp.choices[0].message.content or "").strip() or query
+
+async def aretrieve(query: str, k: int = 5, rewrite: bool = False):
+    """Async retrieval pipeline.
+
+    Embedding the original query and (optionally) rewriting it run
+    concurrently; both variants then go to Chroma in one batched query,
+    and the over-fetched hits are merged by best distance and re-ranked
+    against the original query.
+    """
+    async with _make_async_openai_client() as aclient:
+        emb_task = asyncio.create_task(aembed_batch([query], aclient))
+        if not rewrite:
+            q_embs = await emb_task
+            return (await asyncio.to_thread(retrieve_many, [query], k, q_embs))[0]
+
+        async def rewritten_emb():
+            rq = await arewrite_query(query, aclient)
+            return rq, await aembed_batch([rq], aclient)
+
+        # return_exceptions so emb_task's outcome is always collected here.
+        rewritten, q_emb = await asyncio.gather(rewritten_emb(), emb_task, return_exceptions=True)
+    if isinstance(q_emb, BaseException):
+        raise q_emb
+    if isinstance(rewritten, Exception):
+        # The rewrite is optional: fall back to the original query alone.
+        return (await asyncio.to_thread(retrieve_many, [query], k, q_emb))[0]
+    if isinstance(rewritten, BaseException):
+        raise rewritten
+    rq, rq_emb = rewritten
+
+    hit_lists = await asyncio.to_thread(
+        retrieve_many, [query, rq], k * RERANK_OVERFETCH, np.vstack([q_emb, rq_emb]), False
+    )
+    best = {}
+    for txt, meta, dist in (h for hits in hit_lists for h in hits):
+        key = (meta["source"], meta["chunk_id"])
+        if key not in best or dist < best[key][2]:
+            best[key] = (txt, meta, dist)
+    return rerank(query, sorted(best.values(), key=lambda h: h[2]), k)
 
 def make_prompt(question: str, contexts) -> str:
     joined = "\n\n---\n\n".join(
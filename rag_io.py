@@ -0,0 +1,72 @@
+"""File readers for ingestion.
+
+Kept free of import-time side effects (no vector store, no API clients)
+because ProcessPoolExecutor workers import this module under spawn.
+"""
+import os
+from typing import Iterator, Tuple
+from dotenv import load_dotenv
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+load_dotenv()
+
+PDF_BACKEND = os.getenv("RAG_PDF_BACKEND", "pymupdf").lower()
+
+def read_txt_md(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+def _use_pymupdf() -> bool:
+    if PDF_BACKEND == "pymupdf" and fitz is not None:
+        return True
+    if PdfReader is None:
+        if fitz is None:
+            raise RuntimeError("No PDF backend installed (pip install pymupdf or pypdf)")
+        return True
+    return False
+
+def pdf_page_count(path: str) -> int:
+    if _use_pymupdf():
+        with fitz.open(path) as doc:
+            return doc.page_count
+    return len(PdfReader(path).pages)
+
+def iter_pages(path: str, start: int = 0, stop: int = None) -> Iterator[str]:
+    """Yield the text of each PDF page in [start, stop) without holding the whole document."""
+    if _use_pymupdf():
+        with fitz.open(path) as doc:
+            for i in range(start, doc.page_count if stop is None else stop):
+                try:
+                    yield doc[i].get_text() or ""
+                except Exception:
+                    yield ""
+        return
+    reader = PdfReader(path)
+    for page in reader.pages[start:stop]:
+        try:
+            yield page.extract_text() or ""
+        except Exception:
+            yield ""
+
+def read_pdf(path: str) -> str:
+    return "\n".join(iter_pages(path))
+
+def extract_one(task: Tuple[str, int, int]) -> dict:
+    """Worker entry point: extract one file, or one page range of a PDF."""
+    path, start, stop = task
+    try:
+        if path.lower().endswith(".pdf"):
+            text = "\n".join(iter_pages(path, start, stop))
+        else:
+            text = read_txt_md(path)
+    except Exception:
+        text = ""
+    return {"path": path, "text": text}